@@ -1,11 +1,20 @@
 import os
 import math
+import asyncio
+import bisect
+import multiprocessing
+from datetime import datetime, date as _date
+
+import diskcache
 import numpy as np
+import pandas as pd
 import yfinance as yf
-from scipy.stats import norm, percentileofscore
+from numba import njit, prange, set_num_threads
+from scipy.stats import percentileofscore
 from dotenv import load_dotenv
-from supabase import create_client
-from datetime import datetime
+from supabase import create_client, acreate_client
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 # 1. SETUP & CONNECTION
 # Looks for .env.local in the root directory
@@ -19,226 +28,368 @@ if not url or not key:
 
 supabase = create_client(url, key)
 
+# Option chains are static within a trading day, so cache them on disk and
+# warm same-day reruns skip the network entirely. yfinance routes HTTP
+# through curl_cffi, so the cache wraps the option_chain call itself rather
+# than patching a requests session. The handle is created lazily so each
+# process opens its own.
+CHAIN_CACHE_DIR = ".yf_chain_cache"
+_chain_cache = None
+
+def _get_chain_cache():
+    global _chain_cache
+    if _chain_cache is None:
+        _chain_cache = diskcache.Cache(CHAIN_CACHE_DIR)
+    return _chain_cache
+
+def fetch_chain(ticker_sym, expiry):
+    """Fetches one expiry's (calls, puts) chain, cached on disk for the day."""
+    cache = _get_chain_cache()
+    # Today's date in the key makes same-day reruns hit the cache while the
+    # next day's run refetches
+    cache_key = (ticker_sym, expiry, _date.today().isoformat())
+    chain = cache.get(cache_key)
+    if chain is None:
+        raw = yf.Ticker(ticker_sym).option_chain(expiry)
+        chain = (raw.calls, raw.puts)
+        cache.set(cache_key, chain, expire=3600)
+    return chain
+
 # 2. HELPER FUNCTIONS
-def clean_nan(data):
-    """Recursively converts NaN and Infinity to None for JSON compliance."""
-    if isinstance(data, dict):
-        return {k: clean_nan(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [clean_nan(v) for v in data]
-    elif isinstance(data, float):
-        if math.isnan(data) or math.isinf(data):
-            return None
-    return data
+SQRT_2PI = math.sqrt(2 * math.pi)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _gex_kernel(S, T, r, K, iv, oi, sign):
+    """Black-Scholes Gamma * OI exposure per strike, compiled loop-style.
+
+    Returns the signed GEX contribution for each row. Rows with
+    non-positive IV or strike contribute 0, but NaN/Inf inputs propagate
+    into the output: fastmath elides in-kernel finite checks, so callers
+    must mask non-finite values out of the result.
+    """
+    out = np.zeros(K.size)
+    # Everything constant across the expiry is computed once, outside the loop
+    sqrt_t = math.sqrt(T)
+    log_S = math.log(S)
+    rT = r * T
+    half_T = 0.5 * T
+    inv_S_sqrt_t = 1.0 / (S * sqrt_t * SQRT_2PI)
+    # GEX = Gamma * OpenInterest * 100 * Spot^2 * 0.01
+    contract_scale = sign * 100 * S * S * 0.01
+    for i in prange(K.size):
+        if iv[i] <= 0 or K[i] <= 0:
+            continue
+        d1 = (log_S - math.log(K[i]) + rT + half_T * iv[i] * iv[i]) / (iv[i] * sqrt_t)
+        gamma = math.exp(-0.5 * d1 * d1) * inv_S_sqrt_t / iv[i]
+        out[i] = gamma * oi[i] * contract_scale
+    return out
+
+def find_flip_price(sorted_strikes, strike_map, spot):
+    """Finds the negative-to-positive GEX crossing closest to spot.
+
+    Bisects to spot's position in the sorted strikes and walks outward in
+    each direction until the first crossing, instead of scanning every
+    adjacent pair. Returns spot if there is no crossing.
+    """
+    n = len(sorted_strikes)
+    if n < 2:
+        return spot
+    idx = bisect.bisect_left(sorted_strikes, spot)
 
-def calculate_gamma(S, K, T, r, sigma):
-    """Black-Scholes Gamma calculation."""
-    if T <= 0 or sigma <= 0 or S <= 0:
-        return 0
+    def crossing_at(j):
+        if strike_map[sorted_strikes[j]] < 0 and strike_map[sorted_strikes[j + 1]] > 0:
+            # Return whichever side of the crossing is closer to spot
+            lo, hi = sorted_strikes[j], sorted_strikes[j + 1]
+            return hi if abs(hi - spot) < abs(lo - spot) else lo
+        return None
+
+    # Distance to spot only grows in each direction, so the first crossing
+    # found on each side is the closest one on that side
+    above = None
+    for j in range(max(idx - 1, 0), n - 1):
+        above = crossing_at(j)
+        if above is not None:
+            break
+    below = None
+    for j in range(min(idx - 1, n - 2), -1, -1):
+        below = crossing_at(j)
+        if below is not None:
+            break
+
+    candidates = [c for c in (above, below) if c is not None]
+    if not candidates:
+        return spot
+    return min(candidates, key=lambda c: abs(c - spot))
+
+def fetch_historical_gex():
+    """Fetches all historical total_gex values up front, grouped by ticker.
+
+    Pages through the summaries table because PostgREST caps each response
+    at 1000 rows; stopping at one page would silently truncate the history
+    the percentiles are ranked against.
+    """
+    hist_map = defaultdict(list)
+    page_size = 1000
+    offset = 0
     try:
-        d1 = (np.log(S / K) + (r + 0.5 * sigma**2) * T) / (sigma * np.sqrt(T))
-        gamma = norm.pdf(d1) / (S * sigma * np.sqrt(T))
-        return gamma
-    except:
-        return 0
-
-def get_historical_percentile(ticker_id, current_gex):
-    """Fetches historical total_gex to calculate where today stands (0-100)."""
+        while True:
+            res = (
+                supabase.table("summaries")
+                .select("ticker_id, total_gex")
+                .range(offset, offset + page_size - 1)
+                .execute()
+            )
+            for row in res.data:
+                if row['total_gex'] is not None:
+                    hist_map[row['ticker_id']].append(float(row['total_gex']))
+            if len(res.data) < page_size:
+                break
+            offset += page_size
+    except Exception as e:
+        print(f"Error fetching historical GEX: {e}")
+    return hist_map
+
+def get_historical_percentile(historical_values, current_gex):
+    """Calculates where today's GEX stands against history (0-100)."""
     try:
-        res = supabase.table("summaries").select("total_gex").eq("ticker_id", ticker_id).execute()
-        historical_values = [float(row['total_gex']) for row in res.data if row['total_gex'] is not None]
-        
         if not historical_values:
             return 50  # Default to midpoint if first time running
-        
+
         return int(percentileofscore(historical_values, current_gex))
     except Exception as e:
         print(f"Error calculating percentile: {e}")
         return 50
 
 # 3. MAIN ENGINE
-def process_entire_watchlist():
-    # Fetch tickers from your 'watchlist' table
-    watchlist_res = supabase.table("watchlist").select("id, ticker").execute()
-    tickers = watchlist_res.data
-    all_results = []
-
-    for item in tickers:
-        ticker_sym = item['ticker']
-        ticker_id = item['id']
-        
-        try:
-            print(f"Processing {ticker_sym}...")
-            stock_obj = yf.Ticker(ticker_sym)
-            
-            # Use fast_info or history to get latest price
+def process_ticker(item, spot=None, historical_gex=None):
+    """Computes GEX data for one watchlist entry. Returns None on failure."""
+    ticker_sym = item['ticker']
+    ticker_id = item['id']
+
+    try:
+        print(f"Processing {ticker_sym}...")
+        # yfinance >= 1.0 manages its own shared curl_cffi session with
+        # connection pooling, and rejects externally supplied caching
+        # sessions, so no session is passed here
+        stock_obj = yf.Ticker(ticker_sym)
+
+        # Fall back to a per-ticker history call if the batch download missed it
+        if spot is None:
             history = stock_obj.history(period="1d")
             if history.empty:
                 print(f"Skipping {ticker_sym}: No price data found.")
-                continue
+                return None
             spot = history['Close'].iloc[-1]
-            
-            expirations = stock_obj.options[:10] # Process next 10 expiries
-            total_gex = 0
+        if not math.isfinite(spot):
+            print(f"Skipping {ticker_sym}: No price data found.")
+            return None
+
+        expirations = stock_obj.options[:10] # Process next 10 expiries
+        total_gex = 0
+        per_strike_series = []
+        r = 0.04 # Risk-free rate (Approx 4%)
+
+        # Skip expired or same-day expirations (T must be > 0); ordinal
+        # arithmetic on fromisoformat-parsed dates is several times faster
+        # than strptime and matches the old floor-division day count
+        today_ord = _date.today().toordinal()
+        valid_expiries = []
+        for expiry in expirations:
+            T = (_date.fromisoformat(expiry).toordinal() - today_ord - 1) / 365.0
+            if T > 0:
+                valid_expiries.append((expiry, T))
+
+        # Fetch all chains for this ticker concurrently (network-bound)
+        with ThreadPoolExecutor(max_workers=max(len(valid_expiries), 1)) as chain_pool:
+            chains = list(chain_pool.map(
+                lambda expiry: fetch_chain(ticker_sym, expiry),
+                [expiry for expiry, _ in valid_expiries]
+            ))
+
+        for (expiry, T), (calls, puts) in zip(valid_expiries, chains):
+            # Process calls (positive GEX) and puts (negative GEX) as whole columns
+            for side, sign in ((calls, 1.0), (puts, -1.0)):
+                K = side['strike'].to_numpy(dtype=float)
+                iv = side['impliedVolatility'].to_numpy(dtype=float)
+                oi = side['openInterest'].to_numpy(dtype=float)
+
+                exposure = _gex_kernel(float(spot), T, r, K, iv, oi, sign)
+                exposure = np.where(np.isfinite(exposure), exposure, 0.0)
+
+                total_gex += sign * exposure.sum()
+                # Aggregate on the integer strikes the details table stores,
+                # so no later dedupe pass is needed
+                per_strike_series.append(
+                    pd.Series(exposure).groupby(np.rint(K).astype(int)).sum()
+                )
+
+        # One C-level reduce across all expiries instead of per-expiry dict merges
+        if per_strike_series:
+            strike_map = pd.concat(per_strike_series).groupby(level=0).sum().to_dict()
+        else:
             strike_map = {}
 
-            for date in expirations:
-                # Skip expired or same-day expirations (T must be > 0)
-                T = (datetime.strptime(date, "%Y-%m-%d") - datetime.now()).days / 365.0
-                if T <= 0:
-                    continue
-                    
-                r = 0.04 # Risk-free rate (Approx 4%)
-
-                chain = stock_obj.option_chain(date)
-
-                # Process Calls
-                for _, row in chain.calls.iterrows():
-                    # Check for NaN IV before math
-                    if pd_isna(row.impliedVolatility) or row.impliedVolatility <= 0:
-                        continue
-                    
-                    call_count += 1
-                    gamma = calculate_gamma(spot, row.strike, T, r, row.impliedVolatility)
-                    # GEX = Gamma * OpenInterest * 100 * Spot^2 * 0.01
-                    exposure = gamma * row.openInterest * 100 * (spot**2) * 0.01
-                    if not math.isnan(exposure) and not math.isinf(exposure):
-                        total_gex += exposure
-                        strike_map[row.strike] = strike_map.get(row.strike, 0) + exposure
-
-                # Process Puts
-                for _, row in chain.puts.iterrows():
-                    if pd_isna(row.impliedVolatility) or row.impliedVolatility <= 0:
-                        continue
-                    
-                    put_count += 1
-                    gamma = calculate_gamma(spot, row.strike, T, r, row.impliedVolatility)
-                    exposure = -1 * (gamma * row.openInterest * 100 * (spot**2) * 0.01)
-                    if not math.isnan(exposure) and not math.isinf(exposure):
-                        total_gex -= exposure # Subtracting negative put exposure
-                        strike_map[row.strike] = strike_map.get(row.strike, 0) + exposure
-
-            # 4. Find Gamma Flip Price (closest to spot)
-            sorted_strikes = sorted(strike_map.keys())
-            flip_price = spot
-            
-            # Debug: print gamma around current price
-            relevant_strikes = [s for s in sorted_strikes if spot * 0.95 <= s <= spot * 1.05]
-            print(f"  Strikes around spot ({spot:.2f}):")
-            for s in relevant_strikes[-5:]:
-                print(f"    Strike {s}: GEX = {strike_map[s]:.2f}")
-            
-            # Find gamma flip closest to spot price
-            min_distance = float('inf')
-            for i in range(len(sorted_strikes)-1):
-                if strike_map[sorted_strikes[i]] < 0 and strike_map[sorted_strikes[i+1]] > 0:
-                    # Calculate which strike is closer to spot
-                    candidate = sorted_strikes[i+1] if abs(sorted_strikes[i+1] - spot) < abs(sorted_strikes[i] - spot) else sorted_strikes[i]
-                    distance = abs(candidate - spot)
-                    if distance < min_distance:
-                        min_distance = distance
-                        flip_price = candidate
-
-            # 5. Build Data Objects
-            today_str = datetime.now().date().isoformat()
-            
-            # Ensure total_gex is a valid number (not NaN or None)
-            if math.isnan(total_gex) or total_gex is None:
-                total_gex = 0.0
-            
-            all_results.append({
-                "summary": {
-                    "ticker_id": ticker_id,
-                    "total_gex": float(total_gex),
-                    "flip_price": float(flip_price),
-                    "percentile": get_historical_percentile(ticker_id, total_gex),
-                    "date": today_str
-                },
-                "price": {
-                    "ticker_id": ticker_id,
-                    "price": float(spot),
-                    "date": today_str
-                },
-                "strikes": []
-            })
-            
-            # Build and deduplicate strikes
-            strikes_raw = [
-                {
-                    "ticker_id": ticker_id, 
-                    "strike": int(s), 
-                    "net_gex": float(0 if (math.isnan(g) or g is None) else g), 
-                    "date": today_str
-                } 
-                for s, g in strike_map.items() 
-                if spot * 0.85 <= s <= spot * 1.15 # Filter +/- 15% range
-            ]
-            
-            # Deduplicate by summing net_gex for same strike
-            strikes_dict = {}
-            for strike_record in strikes_raw:
-                strike_key = strike_record["strike"]
-                if strike_key not in strikes_dict:
-                    strikes_dict[strike_key] = strike_record
-                else:
-                    strikes_dict[strike_key]["net_gex"] += strike_record["net_gex"]
-            
-            all_results[-1]["strikes"] = list(strikes_dict.values())
-
-        except Exception as e:
-            print(f"Error processing {ticker_sym}: {e}")
-
-    return all_results
-
-def pd_isna(val):
-    """Checks if a value is NaN using numpy/math."""
-    return val is None or (isinstance(val, float) and math.isnan(val))
+        # 4. Find Gamma Flip Price (closest to spot)
+        sorted_strikes = sorted(strike_map.keys())
 
-def save_to_supabase(all_ticker_data):
-    """Cleans and pushes data to Supabase."""
-    for data in all_ticker_data:
-        try:
-            # SANITIZE for JSON (Remove NaN/Inf)
-            summary_clean = clean_nan(data["summary"])
-            price_clean = clean_nan(data["price"])
-            strikes_clean = clean_nan(data["strikes"])
-            
-            ticker_id = data["summary"]["ticker_id"]
-            today_str = data["summary"]["date"]
-
-            # Delete existing data for today to allow updates
-            try:
-                supabase.table("summaries").delete().eq("ticker_id", ticker_id).eq("date", today_str).execute()
-            except:
-                pass
-            try:
-                supabase.table("prices").delete().eq("ticker_id", ticker_id).eq("date", today_str).execute()
-            except:
-                pass
+        # Debug: print gamma around current price
+        relevant_strikes = [s for s in sorted_strikes if spot * 0.95 <= s <= spot * 1.05]
+        print(f"  Strikes around spot ({spot:.2f}):")
+        for s in relevant_strikes[-5:]:
+            print(f"    Strike {s}: GEX = {strike_map[s]:.2f}")
+
+        flip_price = find_flip_price(sorted_strikes, strike_map, spot)
+
+        # 5. Build Data Objects
+        today_str = datetime.now().date().isoformat()
+
+        # Ensure the summary fields are valid numbers (not NaN/Inf); strike
+        # values are already finite because the kernel output is masked
+        if not math.isfinite(total_gex):
+            total_gex = 0.0
+        if not math.isfinite(flip_price):
+            flip_price = float(spot)
+
+        result = {
+            "summary": {
+                "ticker_id": ticker_id,
+                "total_gex": float(total_gex),
+                "flip_price": float(flip_price),
+                "percentile": get_historical_percentile(historical_gex, total_gex),
+                "date": today_str
+            },
+            "price": {
+                "ticker_id": ticker_id,
+                "price": float(spot),
+                "date": today_str
+            },
+            "strikes": []
+        }
+
+        # strike_map is already keyed by unique integer strikes, so the
+        # records can be built directly with no dedupe pass
+        result["strikes"] = [
+            {
+                "ticker_id": ticker_id,
+                "strike": int(s),
+                "net_gex": float(g if math.isfinite(g) else 0),
+                "date": today_str
+            }
+            for s, g in strike_map.items()
+            if spot * 0.85 <= s <= spot * 1.15 # Filter +/- 15% range
+        ]
+        return result
+
+    except Exception as e:
+        print(f"Error processing {ticker_sym}: {e}")
+        return None
+
+def fetch_spot_prices(symbols):
+    """Fetches latest close for all symbols in one batch download."""
+    spots = {}
+    if not symbols:
+        return spots
+    try:
+        spot_df = yf.download(
+            symbols, period="1d", group_by='ticker', threads=True, progress=False
+        )
+        for sym in symbols:
             try:
-                supabase.table("details").delete().eq("ticker_id", ticker_id).eq("date", today_str).execute()
-            except:
-                pass
-
-            # 1. Insert Summary (with upsert)
-            supabase.table("summaries").upsert(summary_clean, ignore_duplicates=False).execute()
-            
-            # 2. Insert Price (with upsert)
-            supabase.table("prices").upsert(price_clean, ignore_duplicates=False).execute()
-            
-            # 3. Batch Insert Strikes (with upsert)
-            if strikes_clean:
-                # Supabase handles list of dicts as bulk upsert
-                supabase.table("details").upsert(strikes_clean, ignore_duplicates=False).execute()
-            
-            print(f"✅ Data saved for ticker_id: {data['summary']['ticker_id']}")
-        except Exception as e:
-            print(f"❌ Database error: {e}")
+                closes = spot_df[sym]['Close'] if len(symbols) > 1 else spot_df['Close']
+                closes = closes.dropna()
+                if not closes.empty:
+                    spots[sym] = float(closes.iloc[-1])
+            except (KeyError, IndexError):
+                pass # process_ticker falls back to a per-ticker history call
+    except Exception as e:
+        print(f"Batch price download failed: {e}")
+    return spots
+
+def _init_worker():
+    """Per-worker setup for the ticker process pool."""
+    global _chain_cache
+    # Each worker opens its own disk-cache handle rather than reusing one
+    # inherited across the fork
+    _chain_cache = None
+    # One ticker per core already saturates the machine; a full Numba
+    # thread team per worker would just oversubscribe it
+    set_num_threads(1)
+
+def process_entire_watchlist():
+    # Fetch tickers from your 'watchlist' table
+    watchlist_res = supabase.table("watchlist").select("id, ticker").execute()
+    tickers = watchlist_res.data
+
+    # One batch request for all spot prices instead of N history calls
+    spots = fetch_spot_prices([item['ticker'] for item in tickers])
+
+    # One bulk query for percentile history instead of one query per ticker
+    hist_map = fetch_historical_gex()
+
+    # Tickers are independent, so fan out across processes: chain fetches
+    # overlap while the compiled kernel runs on every core, GIL-free. Each
+    # ticker still fetches its own chains concurrently (see process_ticker).
+    args = [
+        (item, spots.get(item['ticker']), hist_map.get(item['id'], []))
+        for item in tickers
+    ]
+    with multiprocessing.Pool(processes=os.cpu_count(), initializer=_init_worker) as pool:
+        results = pool.starmap(process_ticker, args)
+
+    results = [r for r in results if r is not None]
+    if tickers and not results:
+        # Every ticker failing means something systemic broke (e.g. an
+        # upstream API change); fail the run instead of exiting 0 with
+        # nothing written
+        raise RuntimeError(f"All {len(tickers)} watchlist tickers failed to process")
+    return results
+
+def save_to_supabase(all_ticker_data):
+    """Cleans and pushes data to Supabase in three batched upserts."""
+    if not all_ticker_data:
+        return
+
+    # Records are built from finite-masked arrays in process_ticker, so no
+    # recursive NaN scrub is needed here; just batch across all tickers
+    all_summaries = [data["summary"] for data in all_ticker_data]
+    all_prices = [data["price"] for data in all_ticker_data]
+    all_strikes = [s for data in all_ticker_data for s in data["strikes"]]
+
+    today_str = all_summaries[0]["date"]
+    ticker_ids = [s["ticker_id"] for s in all_summaries]
+
+    async def save_batches():
+        # One upsert per table for the whole watchlist, issued concurrently.
+        # on_conflict replaces today's summaries/prices rows outright, but
+        # the details strike window moves with spot, so today's rows are
+        # cleared in one batched delete first or an intraday rerun would
+        # leave strikes from the previous run behind.
+        client = await acreate_client(url, key)
+
+        async def replace_details():
+            await client.table("details").delete().eq("date", today_str).in_("ticker_id", ticker_ids).execute()
+            if all_strikes:
+                await client.table("details").upsert(all_strikes, on_conflict="ticker_id,strike,date").execute()
+
+        await asyncio.gather(
+            client.table("summaries").upsert(all_summaries, on_conflict="ticker_id,date").execute(),
+            client.table("prices").upsert(all_prices, on_conflict="ticker_id,date").execute(),
+            replace_details(),
+        )
+
+    try:
+        asyncio.run(save_batches())
+        print(f"✅ Data saved for {len(all_ticker_data)} tickers")
+    except Exception as e:
+        print(f"❌ Database error: {e}")
 
 # 4. EXECUTION
-if __name__ == "__main__":
+def main():
     results = process_entire_watchlist()
     if results:
         save_to_supabase(results)
     else:
-        print("No results to save.")
\ No newline at end of file
+        print("No results to save.")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -56,14 +56,12 @@ def run_fetch_data():
         logger.info("Starting market data fetch...")
         logger.info("=" * 60)
         
-        # Import and run the fetch script
-        script_path = Path(__file__).parent / "fetch_data.py"
-        
         # Add scripts directory to path
         sys.path.insert(0, str(Path(__file__).parent))
-        
-        # Execute the script
-        exec(open(script_path).read(), {"__name__": "__main__"})
+
+        # Import and run the fetch script
+        import fetch_data
+        fetch_data.main()
         
         logger.info("=" * 60)
         logger.info("Market data fetch completed successfully")
@@ -1,12 +1,13 @@
 import os
 import sys
 import math
+import bisect
 import numpy as np
+import pandas as pd
 import yfinance as yf
-from scipy.stats import norm, percentileofscore
 from dotenv import load_dotenv
 from supabase import create_client
-from datetime import datetime
+from datetime import datetime, date as _date
 
 # Load environment
 load_dotenv(dotenv_path=".env.local")
@@ -25,42 +26,78 @@ if len(sys.argv) < 2:
 
 ticker_sym = sys.argv[1]
 
-def clean_nan(data):
-    """Recursively converts NaN and Infinity to None for JSON compliance."""
-    if isinstance(data, dict):
-        return {k: clean_nan(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [clean_nan(v) for v in data]
-    elif isinstance(data, float):
-        if math.isnan(data) or math.isinf(data):
-            return None
-    return data
+INV_SQRT_2PI = 1 / math.sqrt(2 * math.pi)
 
 def calculate_gamma(S, K, T, r, sigma):
-    """Black-Scholes Gamma calculation."""
-    if T <= 0 or sigma <= 0 or S <= 0:
-        return 0
-    try:
-        d1 = (np.log(S / K) + (r + 0.5 * sigma**2) * T) / (sigma * np.sqrt(T))
-        gamma = norm.pdf(d1) / (S * sigma * np.sqrt(T))
-        return gamma
-    except:
-        return 0
-
-def pd_isna(val):
-    """Checks if a value is NaN using numpy/math."""
-    return val is None or (isinstance(val, float) and math.isnan(val))
+    """Black-Scholes Gamma calculation, vectorized over strike/vol arrays."""
+    if T <= 0 or S <= 0:
+        return np.zeros_like(np.asarray(K, dtype=float))
+    sqrt_t = math.sqrt(T)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        d1 = (np.log(S / K) + (r + 0.5 * sigma**2) * T) / (sigma * sqrt_t)
+        gamma = np.exp(-0.5 * d1 * d1) * (INV_SQRT_2PI / (S * sqrt_t)) / sigma
+    return np.where((sigma > 0) & (K > 0), gamma, 0.0)
+
+def find_flip_price(sorted_strikes, strike_map, spot):
+    """Finds the negative-to-positive GEX crossing closest to spot.
+
+    Bisects to spot's position in the sorted strikes and walks outward in
+    each direction until the first crossing, instead of scanning every
+    adjacent pair. Returns spot if there is no crossing.
+    """
+    n = len(sorted_strikes)
+    if n < 2:
+        return spot
+    idx = bisect.bisect_left(sorted_strikes, spot)
+
+    def crossing_at(j):
+        if strike_map[sorted_strikes[j]] < 0 and strike_map[sorted_strikes[j + 1]] > 0:
+            # Return whichever side of the crossing is closer to spot
+            lo, hi = sorted_strikes[j], sorted_strikes[j + 1]
+            return hi if abs(hi - spot) < abs(lo - spot) else lo
+        return None
+
+    # Distance to spot only grows in each direction, so the first crossing
+    # found on each side is the closest one on that side
+    above = None
+    for j in range(max(idx - 1, 0), n - 1):
+        above = crossing_at(j)
+        if above is not None:
+            break
+    below = None
+    for j in range(min(idx - 1, n - 2), -1, -1):
+        below = crossing_at(j)
+        if below is not None:
+            break
+
+    candidates = [c for c in (above, below) if c is not None]
+    if not candidates:
+        return spot
+    return min(candidates, key=lambda c: abs(c - spot))
 
 def get_historical_percentile(ticker_id, current_gex):
-    """Fetches historical total_gex to calculate where today stands (0-100)."""
+    """Computes where today's GEX stands against history (0-100) server-side.
+
+    Uses the gex_percentile Postgres function (see sql/gex_percentile.sql),
+    falling back to fetching the history if the RPC isn't deployed.
+    """
+    try:
+        res = supabase.rpc("gex_percentile", {"tid": ticker_id, "val": current_gex}).execute()
+        if res.data is not None:
+            return int(res.data)
+        return 50  # Default to midpoint if first time running
+    except Exception as e:
+        print(f"Percentile RPC failed, computing client-side: {e}")
+
     try:
         res = supabase.table("summaries").select("total_gex").eq("ticker_id", ticker_id).execute()
         historical_values = [float(row['total_gex']) for row in res.data if row['total_gex'] is not None]
-        
+
         if not historical_values:
-            return 50  # Default to midpoint if first time running
-        
-        return int(percentileofscore(historical_values, current_gex))
+            return 50
+
+        # Same strict percentile the SQL function computes
+        return int(100 * sum(v < current_gex for v in historical_values) / len(historical_values))
     except Exception as e:
         print(f"Error calculating percentile: {e}")
         return 50
@@ -84,74 +121,74 @@ try:
         sys.exit(1)
     
     spot = history['Close'].iloc[-1]
-    
+    if not math.isfinite(spot):
+        print(f"Skipping {ticker_sym}: No price data found.")
+        sys.exit(1)
+
+
     expirations = stock_obj.options[:10]  # Process next 10 expiries
     total_gex = 0
-    strike_map = {}
+    per_strike_series = []
     call_count = 0
     put_count = 0
 
+    # Ordinal arithmetic on fromisoformat-parsed dates is several times
+    # faster than strptime and matches the old floor-division day count
+    today_ord = _date.today().toordinal()
     for date in expirations:
         # Skip expired or same-day expirations (T must be > 0)
-        T = (datetime.strptime(date, "%Y-%m-%d") - datetime.now()).days / 365.0
+        T = (_date.fromisoformat(date).toordinal() - today_ord - 1) / 365.0
         if T <= 0:
             continue
             
         r = 0.04  # Risk-free rate (Approx 4%)
 
         chain = stock_obj.option_chain(date)
-        
-        # Process Calls
-        for _, row in chain.calls.iterrows():
-            # Check for NaN IV before math
-            if pd_isna(row.impliedVolatility) or row.impliedVolatility <= 0:
-                continue
-            
-            call_count += 1
-            gamma = calculate_gamma(spot, row.strike, T, r, row.impliedVolatility)
-            if math.isnan(gamma) or gamma <= 0:
-                continue
+
+        # Process calls (positive GEX) and puts (negative GEX) as whole columns
+        for side, sign in ((chain.calls, 1.0), (chain.puts, -1.0)):
+            K = side['strike'].to_numpy(dtype=float)
+            iv = side['impliedVolatility'].to_numpy(dtype=float)
+            oi = side['openInterest'].to_numpy(dtype=float)
+
+            # Mask out rows with missing/zero IV or OI before the math
+            mask = np.isfinite(iv) & (iv > 0) & np.isfinite(oi)
+            if sign > 0:
+                call_count += int(mask.sum())
+            else:
+                put_count += int(mask.sum())
+
+            gamma = calculate_gamma(spot, K, T, r, iv)
             # GEX = Gamma * OpenInterest * 100 * Spot^2 * 0.01
-            exposure = gamma * row.openInterest * 100 * (spot**2) * 0.01
-            if not math.isnan(exposure) and not math.isinf(exposure):
-                total_gex += exposure
-                strike_map[row.strike] = strike_map.get(row.strike, 0) + exposure
-
-        # Process Puts
-        for _, row in chain.puts.iterrows():
-            if pd_isna(row.impliedVolatility) or row.impliedVolatility <= 0:
-                continue
-            
-            put_count += 1
-            gamma = calculate_gamma(spot, row.strike, T, r, row.impliedVolatility)
-            if math.isnan(gamma) or gamma <= 0:
-                continue
-            exposure = -1 * (gamma * row.openInterest * 100 * (spot**2) * 0.01)
-            if not math.isnan(exposure) and not math.isinf(exposure):
-                total_gex -= exposure  # Subtracting negative put exposure
-                strike_map[row.strike] = strike_map.get(row.strike, 0) + exposure
+            exposure = np.where(mask, gamma * oi * 100 * (spot**2) * 0.01, 0.0)
+            exposure = np.where(np.isfinite(exposure), exposure, 0.0)
+
+            total_gex += exposure.sum()
+            # Aggregate on the integer strikes the details table stores,
+            # so no later dedupe pass is needed
+            per_strike_series.append(
+                pd.Series(sign * exposure).groupby(np.rint(K).astype(int)).sum()
+            )
+
+    # One C-level reduce across all expiries instead of per-expiry dict merges
+    if per_strike_series:
+        strike_map = pd.concat(per_strike_series).groupby(level=0).sum().to_dict()
+    else:
+        strike_map = {}
 
     # 4. Find Gamma Flip Price (closest to spot)
     sorted_strikes = sorted(strike_map.keys())
-    flip_price = spot
-    
-    # Find gamma flip closest to spot price
-    min_distance = float('inf')
-    for i in range(len(sorted_strikes)-1):
-        if strike_map[sorted_strikes[i]] < 0 and strike_map[sorted_strikes[i+1]] > 0:
-            # Calculate which strike is closer to spot
-            candidate = sorted_strikes[i+1] if abs(sorted_strikes[i+1] - spot) < abs(sorted_strikes[i] - spot) else sorted_strikes[i]
-            distance = abs(candidate - spot)
-            if distance < min_distance:
-                min_distance = distance
-                flip_price = candidate
+    flip_price = find_flip_price(sorted_strikes, strike_map, spot)
 
     # 5. Build Data Objects
     today_str = datetime.now().date().isoformat()
     
-    # Ensure total_gex is a valid number (not NaN or None)
-    if math.isnan(total_gex) or total_gex is None:
+    # Ensure the summary fields are valid numbers (not NaN/Inf); strike
+    # values are already finite because the exposure arrays are masked
+    if not math.isfinite(total_gex):
         total_gex = 0.0
+    if not math.isfinite(flip_price):
+        flip_price = float(spot)
     
     summary = {
         "ticker_id": ticker_id,
@@ -167,58 +204,34 @@ try:
         "date": today_str
     }
     
+    # strike_map is already keyed by unique integer strikes, so the
+    # records can be built directly with no dedupe pass
     strikes = [
         {
-            "ticker_id": ticker_id, 
-            "strike": int(s), 
-            "net_gex": float(0 if (math.isnan(g) or g is None) else g), 
+            "ticker_id": ticker_id,
+            "strike": int(s),
+            "net_gex": float(g if math.isfinite(g) else 0),
             "date": today_str
-        } 
-        for s, g in strike_map.items() 
+        }
+        for s, g in strike_map.items()
         if spot * 0.85 <= s <= spot * 1.15  # Filter +/- 15% range
     ]
-    
-    # Deduplicate strikes by summing net_gex for same strike
-    strikes_dict = {}
-    for strike_record in strikes:
-        strike_key = strike_record["strike"]
-        if strike_key not in strikes_dict:
-            strikes_dict[strike_key] = strike_record
-        else:
-            strikes_dict[strike_key]["net_gex"] += strike_record["net_gex"]
-    
-    strikes = list(strikes_dict.values())
 
-    # Save to Supabase
+    # Save to Supabase; on_conflict replaces today's rows (see
+    # sql/unique_constraints.sql), so summaries/prices need no delete pass
     try:
-        # SANITIZE for JSON (Remove NaN/Inf)
-        summary_clean = clean_nan(summary)
-        price_clean = clean_nan(price)
-        strikes_clean = clean_nan(strikes)
-
-        # Delete existing data for today to allow updates
-        try:
-            supabase.table("summaries").delete().eq("ticker_id", ticker_id).eq("date", today_str).execute()
-        except:
-            pass
-        try:
-            supabase.table("prices").delete().eq("ticker_id", ticker_id).eq("date", today_str).execute()
-        except:
-            pass
-        try:
-            supabase.table("details").delete().eq("ticker_id", ticker_id).eq("date", today_str).execute()
-        except:
-            pass
-
         # 1. Insert Summary (with upsert)
-        supabase.table("summaries").upsert(summary_clean, ignore_duplicates=False).execute()
-        
+        supabase.table("summaries").upsert(summary, on_conflict="ticker_id,date").execute()
+
         # 2. Insert Price (with upsert)
-        supabase.table("prices").upsert(price_clean, ignore_duplicates=False).execute()
-        
-        # 3. Batch Insert Strikes (with upsert)
-        if strikes_clean:
-            supabase.table("details").upsert(strikes_clean, ignore_duplicates=False).execute()
+        supabase.table("prices").upsert(price, on_conflict="ticker_id,date").execute()
+
+        # 3. Batch Insert Strikes (with upsert). The strike window moves
+        # with spot, so clear today's rows first or an intraday rerun
+        # would leave strikes from the previous run behind.
+        supabase.table("details").delete().eq("ticker_id", ticker_id).eq("date", today_str).execute()
+        if strikes:
+            supabase.table("details").upsert(strikes, on_conflict="ticker_id,strike,date").execute()
         
         print(f"✅ Data saved for {ticker_sym}")
     except Exception as e:
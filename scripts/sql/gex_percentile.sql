@@ -0,0 +1,17 @@
+-- One-time setup: percentile of a GEX value against a ticker's history,
+-- computed server-side so the fetch scripts get back a single integer
+-- instead of downloading every historical total_gex row.
+-- Run this in the Supabase SQL editor.
+
+create or replace function gex_percentile(tid uuid, val float8)
+returns int
+language sql
+stable
+as $$
+  select coalesce(
+    (100 * (count(*) filter (where total_gex < val))::float
+       / nullif(count(*), 0))::int,
+    50)
+  from summaries
+  where ticker_id = tid;
+$$;
@@ -0,0 +1,14 @@
+-- One-time setup: unique keys the fetch scripts' upserts rely on.
+-- With these in place an upsert with on_conflict replaces today's
+-- summaries/prices rows outright. details still gets one batched delete
+-- per run because its strike window moves with spot intraday.
+-- Run this in the Supabase SQL editor.
+
+alter table summaries
+  add constraint summaries_ticker_id_date_key unique (ticker_id, date);
+
+alter table prices
+  add constraint prices_ticker_id_date_key unique (ticker_id, date);
+
+alter table details
+  add constraint details_ticker_id_strike_date_key unique (ticker_id, strike, date);